@@ -1,23 +1,67 @@
-import os
+import logging
 import re
-import requests
-import sqlalchemy as db
 
-from .MardiEntities import MardiItem, MardiProperty
+from .MardiEntities import (MardiItem, MardiProperty, _cached_search, _store_search, response_json,
+                            sparql_string, sparql_value)
+from .mardi_api import MardiAPIMixin
 from .mardi_config import config
 from .mathml_datatype import MathML
 from wikibaseintegrator import WikibaseIntegrator, wbi_login
 from wikibaseintegrator.wbi_config import config as wbi_config
-from wikibaseintegrator.wbi_helpers import execute_sparql_query
 from wikibaseintegrator.wbi_login import LoginError
 from wikibaseintegrator.datatypes import (URL, CommonsMedia, ExternalID, Form, GeoShape, GlobeCoordinate, Item, Lexeme, Math, MonolingualText, MusicalNotation, Property, Quantity,
                                           Sense, String, TabularData, Time)
 
-class MardiClient(WikibaseIntegrator):
+log = logging.getLogger(__name__)
+
+WIKIDATA_ID_RE = re.compile(r'^wdt?:([PQ]\d+$)')
+
+# Claim class corresponding to each Wikibase datatype
+DATATYPE_CLASSES = {
+    'wikibase-item': Item,
+    'commonsMedia': CommonsMedia,
+    'external-id': ExternalID,
+    'wikibase-form': Form,
+    'geo-shape': GeoShape,
+    'globe-coordinate': GlobeCoordinate,
+    'wikibase-lexeme': Lexeme,
+    'math': Math,
+    'monolingualtext': MonolingualText,
+    'musical-notation': MusicalNotation,
+    'wikibase-property': Property,
+    'quantity': Quantity,
+    'wikibase-sense': Sense,
+    'string': String,
+    'tabular-data': TabularData,
+    'time': Time,
+    'url': URL,
+    'mathml': MathML,
+}
+
+# Datatypes whose claim class takes the value under another keyword
+VALUE_KWARGS = {
+    'monolingualtext': 'text',
+    'quantity': 'amount',
+    'time': 'time',
+}
+
+def _is_local_id(entity_str):
+    """Whether a string is a local ID such as 'P31' or 'Q5'. Only
+    ASCII digits count, unlike for str.isdigit or regex digit classes"""
+    return (len(entity_str) > 1 and entity_str[0] in ('P', 'Q')
+            and entity_str.isascii() and entity_str[1:].isdigit())
+
+class MardiClient(MardiAPIMixin, WikibaseIntegrator):
     def __init__(self, **kwargs) -> None:
         super().__init__(is_bot=True)
         self.login = self.config(**kwargs)
+        self.session = self.get_session()
+        self._sparql_prefix = self.get_sparql_prefix()
         self.importer_api = config['IMPORTER_API_URL']
+        # Entities keep a shallow copy of the client as api, so the caches
+        # must exist before them to be shared with every copy
+        self._label_cache = {}
+        self._datatype_cache = {}
         self.item = MardiItem(api=self)
         self.property = MardiProperty(api=self)
 
@@ -44,7 +88,13 @@ class MardiClient(WikibaseIntegrator):
                     password=password
                 )
         except LoginError:
-            print('Wrong credentials')
+            log.error('Wrong credentials')
+
+    @property
+    def instance_of_PID(self):
+        """Local ID of the 'instance of' property. It is resolved once
+        and kept in the label cache shared with the entity copies"""
+        return self.get_local_id_by_label('instance of', 'property')
 
     def get_local_id_by_label(self, entity_str, entity_type):
         """Check if entity with a given label or wikidata PID/QID 
@@ -60,11 +110,25 @@ class MardiClient(WikibaseIntegrator):
         Returns:
            str: Local ID of the entity, if found.
         """
-        local_pattern = r'^[PQ]\d+$'
-        wikidata_pattern = r'^wdt?:([PQ]\d+$)'
-        if re.match(local_pattern, entity_str):
+        # Local IDs are the common case and need neither cache nor regex
+        if _is_local_id(entity_str):
             return entity_str
-        elif not entity_str.startswith("wdt:") and not entity_str.startswith("wd:"):
+        # Item labels are left to the importer search cache, which
+        # expires and is invalidated when items are written
+        if entity_type == 'item' and not entity_str.startswith(("wdt:", "wd:")):
+            return self._resolve_local_id(entity_str, entity_type)
+        key = (entity_str, entity_type)
+        if key in self._label_cache:
+            return self._label_cache[key]
+        local_id = self._resolve_local_id(entity_str, entity_type)
+        # Misses are not cached, so entities created later are still found
+        if local_id:
+            self._label_cache[key] = local_id
+        return local_id
+
+    def _resolve_local_id(self, entity_str, entity_type):
+        """Uncached lookup behind get_local_id_by_label"""
+        if not entity_str.startswith("wdt:") and not entity_str.startswith("wd:"):
             if entity_type == "property":
                 new_property = MardiProperty(api=self).new()
                 new_property.labels.set(language='en', value=entity_str)
@@ -73,37 +137,77 @@ class MardiClient(WikibaseIntegrator):
                 new_item = MardiItem(api=self).new()
                 new_item.labels.set(language='en', value=entity_str)
                 return new_item.get_QID()
-        elif re.match(wikidata_pattern, entity_str):
-            match = re.match(wikidata_pattern, entity_str)
+        match = WIKIDATA_ID_RE.match(entity_str)
+        if match:
             wikidata_id = match.group(1)
             if wikidata_id.startswith("Q"):
-                response = requests.get(f'{self.importer_api}/items/{entity_str}/mapping')
-                response = response.json()
+                response = self.session.get(f'{self.importer_api}/items/{entity_str}/mapping')
+                response = response_json(response)
                 return response.get('local_id')
             elif wikidata_id.startswith("P"):
-                response = requests.get(f'{self.importer_api}/properties/{entity_str}/mapping')
-                response = response.json()
+                response = self.session.get(f'{self.importer_api}/properties/{entity_str}/mapping')
+                response = response_json(response)
                 return response.get('local_id')     
 
-    def search_entity_by_value(self, prop_nr, value):
-        prefix = None
-        if (wbi_config['SPARQL_ENDPOINT_URL'] == 
-            'http://query.portal.mardi4nfdi.de/proxy/wdqs/bigdata/namespace/wdq/sparql'):
-            prefix = "PREFIX wdt: <https://portal.mardi4nfdi.de/prop/direct/>"
+    def resolve_many(self, labels, entity_type, batch_size=100):
+        """Resolves several english labels at once through SPARQL and
+        stores the local IDs found in the caches used by
+        get_local_id_by_label, so that later lookups need no request.
+        Item labels are stored in the expiring importer search cache.
 
+        Args:
+            labels (list): Labels to be resolved.
+            entity_type (str): Either 'property' or 'item' to specify
+                which type of entity to look for.
+            batch_size (int): Number of labels sent per query.
+
+        Returns:
+            dict: Local ID for each label that was found. As in
+                get_local_id_by_label, items map to a list of QIDs.
+        """
+        id_prefix = 'P' if entity_type == 'property' else 'Q'
+        pending = list({label for label in labels
+                        if not _is_local_id(label)
+                        and not label.startswith(("wdt:", "wd:"))
+                        and not self._cached_local_id(label, entity_type)})
+        for i in range(0, len(pending), batch_size):
+            values = ' '.join(f'{sparql_string(label)}@en' for label in pending[i:i + batch_size])
+            query = f'SELECT ?item ?label WHERE {{ VALUES ?label {{ {values} }} ?item rdfs:label ?label . }}'
+            found = {}
+            for binding in self.execute_sparql(query):
+                local_id = sparql_value(binding['item'])
+                if local_id.startswith(id_prefix):
+                    found.setdefault(binding['label']['value'], []).append(local_id)
+            for label, local_ids in found.items():
+                if entity_type == 'item':
+                    _store_search(self.importer_api, 'items', label, local_ids)
+                else:
+                    self._label_cache[(label, entity_type)] = local_ids[0]
+
+        resolved = {}
+        for label in labels:
+            local_id = self._cached_local_id(label, entity_type)
+            if local_id:
+                resolved[label] = local_id
+        return resolved
+
+    def _cached_local_id(self, label, entity_type):
+        """Local ID of a label as cached for get_local_id_by_label,
+        or None. Item labels are looked up in the importer search cache,
+        where only results that have not expired count."""
+        if entity_type == 'item':
+            QID_list = _cached_search(self.importer_api, 'items', label)
+            return list(QID_list) if QID_list else None
+        return self._label_cache.get((label, entity_type))
+
+    def search_entity_by_value(self, prop_nr, value):
         prop_nr = self.get_local_id_by_label(prop_nr, 'property')
         if isinstance(value, str): 
             value = f'"{value}"'
 
         query = f'SELECT ?item WHERE {{?item wdt:{prop_nr} {value}}}'
-        result = execute_sparql_query(query, prefix)
-
-        QID_list = []
-        for item in result['results']['bindings']:
-            match = re.search(r'\/(Q\d+)$', item['item']['value'])
-            QID = match.group(1)
-            QID_list.append(QID)
-        return QID_list    
+        return [item['item']['value'].rpartition('/')[2]
+                for item in self.execute_sparql(query)]
 
     def get_claim(self, prop_nr, value=None, **kwargs):
         """
@@ -123,55 +227,20 @@ class MardiClient(WikibaseIntegrator):
 
         """
         prop_nr = self.get_local_id_by_label(prop_nr, 'property')
-        try:
-            prop = self.property.get(entity_id=prop_nr)
-        except ValueError:
-            datatype = "mathml"
-        else:
-            datatype = prop.datatype.value
+        # The datatype of a property never changes, so fetch it only once
+        datatype = self._datatype_cache.get(prop_nr)
+        if datatype is None:
+            try:
+                prop = self.property.get(entity_id=prop_nr)
+            except ValueError:
+                datatype = "mathml"
+            else:
+                datatype = prop.datatype.value
+            self._datatype_cache[prop_nr] = datatype
         kwargs['prop_nr'] = prop_nr
-        kwargs['value'] = value
-        if datatype == 'wikibase-item':
-            if value.startswith("wd:"):
-                kwargs['value'] = self.get_local_id_by_label(value, 'item')
-            return Item(**kwargs)
-        elif datatype == 'commonsMedia':
-            return CommonsMedia(**kwargs)
-        elif datatype == 'external-id':
-            return ExternalID(**kwargs)
-        elif datatype == 'wikibase-form':
-            return Form(**kwargs)
-        elif datatype == 'geo-shape':
-            return GeoShape(**kwargs)
-        elif datatype == 'globe-coordinate':
-            return GlobeCoordinate(**kwargs)
-        elif datatype == 'wikibase-lexeme':
-            return Lexeme(**kwargs)
-        elif datatype == 'math':
-            return Math(**kwargs)
-        elif datatype == 'monolingualtext':
-            kwargs['text'] = value
-            kwargs.pop("value")
-            return MonolingualText(**kwargs)
-        elif datatype == 'musical-notation':
-            return MusicalNotation(**kwargs)
-        elif datatype == 'wikibase-property':
-            return Property(**kwargs)
-        elif datatype == 'quantity':
-            kwargs['amount'] = value
-            kwargs.pop("value")
-            return Quantity(**kwargs)
-        elif datatype == 'wikibase-sense':
-            return Sense(**kwargs)
-        elif datatype == 'string':
-            return String(**kwargs)
-        elif datatype == 'tabular-data':
-            return TabularData(**kwargs)
-        elif datatype == 'time':
-            kwargs['time'] = value
-            kwargs.pop("value")
-            return Time(**kwargs)
-        elif datatype == 'url':
-            return URL(**kwargs)
-        elif datatype == 'mathml':
-            return MathML(**kwargs)
+        kwargs[VALUE_KWARGS.get(datatype, 'value')] = value
+        if datatype == 'wikibase-item' and value.startswith("wd:"):
+            kwargs['value'] = self.get_local_id_by_label(value, 'item')
+        datatype_class = DATATYPE_CLASSES.get(datatype)
+        if datatype_class:
+            return datatype_class(**kwargs)
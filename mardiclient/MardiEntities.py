@@ -1,13 +1,113 @@
+import logging
 import re
-import os
-import requests
-import sqlalchemy as db
-from sqlalchemy import and_
+import time
+
+from urllib.parse import quote
 
 from wikibaseintegrator.entities import ItemEntity, PropertyEntity
 from wikibaseintegrator.wbi_exceptions import ModificationFailed
 from wikibaseintegrator.datatypes import ExternalID
+from wikibaseintegrator.models import Claims
 from wikibaseintegrator.wbi_enums import ActionIfExists
+from wikibaseintegrator.wbi_helpers import mediawiki_api_call_helper
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+QID_RE = re.compile(r'Q\d+')
+ENTITY_URI_RE = re.compile(r'/entity/([PQ]\d+)$')
+
+# Plain value stored in the datavalue of each supported datatype
+VALUE_EXTRACTORS = {
+    'string': lambda value: value,
+    'external-id': lambda value: value,
+    'wikibase-item': lambda value: value['id'],
+    'time': lambda value: value['time'],
+}
+
+def response_json(response):
+    """Decodes the JSON body of a response, using orjson if installed"""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+# Importer search results per (endpoint, kind, label), kept for a short
+# time so that repeated checks on the same label reuse them. Misses
+# expire as well, so entities created elsewhere are found later on.
+SEARCH_CACHE_TTL = 60
+SEARCH_CACHE_MAXSIZE = 4096
+_search_cache = {}
+
+def _search(session, endpoint, kind, label, field):
+    """Importer search for the entities of a kind ('items' or
+    'properties') with a label, cached for SEARCH_CACHE_TTL seconds.
+    Returns the given field of the response."""
+    key = (endpoint, kind, label)
+    cached = _search_cache.pop(key, None)
+    if cached is None or cached[0] <= time.monotonic():
+        response = session.get(f'{endpoint}/search/{kind}/{quote(label, safe="")}')
+        cached = (time.monotonic() + SEARCH_CACHE_TTL, response_json(response).get(field))
+        if len(_search_cache) >= SEARCH_CACHE_MAXSIZE:
+            _search_cache.pop(next(iter(_search_cache)), None)
+    _search_cache[key] = cached
+    return cached[1]
+
+def _search_items(session, endpoint, label):
+    """Cached importer search for the QIDs of items with a label"""
+    return tuple(_search(session, endpoint, 'items', label, 'QID') or [])
+
+def _search_properties(session, endpoint, label):
+    """Cached importer search for the PID of the property with a label"""
+    return _search(session, endpoint, 'properties', label, 'PID')
+
+def _cached_search(endpoint, kind, label):
+    """Returns the cached importer search result for a label if it has
+    not expired yet, otherwise None"""
+    cached = _search_cache.get((endpoint, kind, label))
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+
+def _store_search(endpoint, kind, label, value):
+    """Stores a result found by other means, e.g. SPARQL, as if it
+    came from the importer search"""
+    _search_cache.pop((endpoint, kind, label), None)
+    if len(_search_cache) >= SEARCH_CACHE_MAXSIZE:
+        _search_cache.pop(next(iter(_search_cache)), None)
+    _search_cache[(endpoint, kind, label)] = (time.monotonic() + SEARCH_CACHE_TTL, value)
+
+def invalidate_search(label):
+    """Drops the cached importer search results for a label, e.g.
+    after an entity with that label has been written"""
+    for key in [key for key in _search_cache if key[2] == label]:
+        _search_cache.pop(key, None)
+
+def sparql_string(value):
+    """Quotes a string as a SPARQL literal"""
+    value = (value.replace('\\', '\\\\').replace('"', '\\"')
+             .replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t'))
+    return f'"{value}"'
+
+def label_or_alias_pattern(label):
+    """SPARQL pattern binding ?item to entities with the given
+    english label or alias"""
+    literal = sparql_string(label)
+    return (f'{{ ?item rdfs:label {literal}@en }} UNION '
+            f'{{ ?item skos:altLabel {literal}@en }}')
+
+def sparql_value(binding):
+    """Converts a SPARQL result value to its representation in the
+    Wikibase JSON, i.e. entity IDs for entity URIs. Other values,
+    URLs included, are returned unchanged"""
+    value = binding['value']
+    if binding['type'] == 'uri':
+        match = ENTITY_URI_RE.search(value)
+        if match:
+            return match.group(1)
+    return value
 
 class MardiItem(ItemEntity):
 
@@ -17,6 +117,10 @@ class MardiItem(ItemEntity):
     def write(self, **kwargs):
         try:
             entity = super().write(**kwargs)
+            # The new label must be visible to later searches
+            label = entity.labels.get('en')
+            if label:
+                invalidate_search(label.value)
             return entity
         except ModificationFailed as e:
             return self.handleModificationFailed(e)
@@ -24,11 +128,11 @@ class MardiItem(ItemEntity):
     def handleModificationFailed(self, e):
         """Handle ModificationFailed Exception
         """
-        print('Item with given label and description already exists.')
-        match = re.search(r'Q\d+', str(e))
+        log.warning('Item with given label and description already exists.')
+        match = QID_RE.search(str(e))
         if match:
             qid = match.group()
-            print(f'Existing item with QID: {qid} is returned')
+            log.warning('Existing item with QID: %s is returned', qid)
             return self.api.item.get(entity_id=qid)
 
     def get(self, entity_id, **kwargs):
@@ -36,26 +140,74 @@ class MardiItem(ItemEntity):
         return MardiItem(api=self.api).from_json(json_data=json_data['entities'][entity_id])
 
     def exists(self): 
-        """Checks through the Wikibase DB if an item with same label
-        and description already exists
+        """Checks if an item with same label and description already
+        exists. A SPARQL query is tried first; if the endpoint fails,
+        the items found by the importer search are checked in
+        wbgetentities batches instead
 
         Returns:
             id (str): ID of the item if found, otherwise None.
         """
 
-        description = ""
-        if 'en' in self.descriptions.values:
-            description = self.descriptions.values['en'].value
+        en = self.labels.values.get('en')
+        label = en.value if en else ""
+
+        en = self.descriptions.values.get('en')
+        description = en.value if en else ""
+
+        # Label and description can be matched by a single query
+        query = (f'SELECT ?item WHERE {{ ?item rdfs:label {sparql_string(label)}@en ; '
+                 f'schema:description {sparql_string(description)}@en . }} LIMIT 1')
+        try:
+            # A single attempt without waiting, the fallback is cheaper than a retry
+            bindings = self.api.execute_sparql(query, max_retries=1, retry_after=0)
+        except Exception as e:
+            log.warning('SPARQL endpoint unavailable (%s), checking candidates instead', e)
+        else:
+            if bindings:
+                return sparql_value(bindings[0]['item'])
+            return None
 
         # List of items with the same label
         QID_list = self.get_QID()
 
         # Check if there is an item with the same description
-        for QID in QID_list:
-            item = ItemEntity(api=self.api).new()
-            item = item.get(QID)
-            if description == item.descriptions.values.get('en'):
-                return QID
+        for entity in self._bulk_get_json(QID_list, props='descriptions', languages='en'):
+            en = entity.get('descriptions', {}).get('en')
+            if en and description == en['value']:
+                return entity['id']
+
+    def _bulk_get_json(self, QID_list, props=None, languages=None):
+        """
+        Internal method to fetch the JSON of several items, with one
+        wbgetentities request per 50 IDs
+
+        Args:
+            QID_list (list): IDs of the items to be fetched.
+            props (str): Parts of the entities to be returned, e.g.
+                'claims'. All of them if not given.
+            languages (str): Languages of the labels, descriptions and
+                aliases to be returned, e.g. 'en'. All of them if not
+                given.
+
+        Yields:
+            dict: JSON of each item. No further batch is requested
+                once the caller stops iterating.
+        """
+        for i in range(0, len(QID_list), 50):
+            batch = QID_list[i:i + 50]
+            params = {
+                'action': 'wbgetentities',
+                'ids': '|'.join(batch),
+                'format': 'json'
+            }
+            if props:
+                params['props'] = props
+            if languages:
+                params['languages'] = languages
+            json_data = mediawiki_api_call_helper(data=params, login=self.api.login,
+                                                  allow_anonymous=True, is_bot=self.api.is_bot)
+            yield from json_data['entities'].values()
 
     def add_claim(self, prop_nr, value=None, action="append_or_replace", **kwargs):
         """
@@ -94,44 +246,18 @@ class MardiItem(ItemEntity):
         Returns:
             id (str): ID of the item if found, otherwise None.
         """
-        label = ""
-        if 'en' in self.labels.values:
-            label = self.labels.values['en'].value
-
-        instance_QID = self.api.get_local_id_by_label(instance, 'item')
-        if type(instance_QID) is list: instance_QID = instance_QID[0]
-
-        instance_of_PID = self.api.get_local_id_by_label('instance of', 'property')
-
-        item_QID_list = self.get_QID()
-        for QID in item_QID_list:
-            item = self.api.item.get(QID)
-            item_claims = item.get_json()['claims']
-            if instance_of_PID in item_claims:
-                if (instance_QID == 
-                    item_claims[instance_of_PID][0]['mainsnak']['datavalue']['value']['id']):
-                    return item.id
+        query = f'SELECT ?item WHERE {{ {self._instance_pattern(instance)} }} LIMIT 1'
+        for binding in self.api.execute_sparql(query):
+            return sparql_value(binding['item'])
         return False
 
     def get_instance_list(self, instance):
         """Returns all items that have the same label, or an alias with
         the label, and are an instance of 'instance'
         """
-        instance_QID = self.api.get_local_id_by_label(instance, 'item')
-        if type(instance_QID) is list: instance_QID = instance_QID[0]
-
-        instance_of_PID = self.api.get_local_id_by_label('instance of', 'property')
-
-        item_QID_list = self.get_QID(alias=True)
-        items = []
-        for QID in item_QID_list:
-            item = self.api.item.get(QID)
-            item_claims = item.get_json()['claims']
-            if instance_of_PID in item_claims:
-                if (instance_QID == 
-                    item_claims[instance_of_PID][0]['mainsnak']['datavalue']['value']['id']):
-                    items.append(item.id)
-        return items
+        query = f'SELECT DISTINCT ?item WHERE {{ {self._instance_pattern(instance, alias=True)} }}'
+        return [sparql_value(binding['item'])
+                for binding in self.api.execute_sparql(query)]
 
     def is_instance_of_with_property(self, instance, prop_str, value):
         """Checks if a given entity is an instance of 'instance' item 
@@ -153,13 +279,44 @@ class MardiItem(ItemEntity):
         Returns:
             id (str): ID of the item if found, otherwise None.
         """
-        item_QID_list = self.get_instance_list(instance)
         prop_nr = self.api.get_local_id_by_label(prop_str, 'property')
-        for item_QID in item_QID_list:
-            item = self.api.item.get(item_QID)
-            item_claims = item.get_json()['claims']
-            values = self.__return_values(prop_nr, item_claims)
-            if value in values: return item_QID
+
+        # The query service normalises values, e.g. timestamps of year
+        # precision, so they are compared in their Wikibase JSON form
+        QID_list = self.get_instance_list(instance)
+        for entity in self._bulk_get_json(QID_list, props='claims'):
+            item_claims = Claims().from_json(entity.get('claims', {}))
+            if value in self.__return_values(prop_nr, item_claims):
+                return entity['id']
+
+    def _instance_pattern(self, instance, alias=False):
+        """
+        Internal method to build the SPARQL pattern matching the items
+        with the same label that are an instance of 'instance'. The
+        instance and 'instance of' IDs are resolved here only once.
+
+        Args:
+            instance (str): Identifier for instance. The prefix "wd:" 
+                can be used for items for wikidata.
+            alias (bool): Whether items with the label as an alias
+                also match.
+
+        Returns:
+            str: SPARQL pattern binding ?item.
+        """
+        en = self.labels.values.get('en')
+        label = en.value if en else ""
+
+        instance_QID = self.api.get_local_id_by_label(instance, 'item')
+        if type(instance_QID) is list: instance_QID = instance_QID[0]
+
+        instance_of_PID = self.api.instance_of_PID
+
+        if alias:
+            label_pattern = label_or_alias_pattern(label)
+        else:
+            label_pattern = f'?item rdfs:label {sparql_string(label)}@en .'
+        return f'{label_pattern} ?item wdt:{instance_of_PID} wd:{instance_QID} .'
 
     def get_value(self, prop_str):
         """
@@ -176,13 +333,18 @@ class MardiItem(ItemEntity):
                 statement corresponding to the property.
 
         """
-        QID = self.id if self.id else self.exists()
-        if QID:
-            item = ItemEntity(api=self.api).new()
-            item = item.get(QID)
-            item_claims = item.get_json()['claims']
-            prop_nr = self.api.get_local_id_by_label(prop_str, 'property')
-            return self.__return_values(prop_nr, item_claims)
+        if self.id and len(self.claims):
+            # The item is already loaded, no need to fetch it again
+            item_claims = self.claims
+        else:
+            QID = self.id if self.id else self.exists()
+            if not QID:
+                return None
+            # Only the claims are needed, so skip the rest of the entity
+            entity = next(self._bulk_get_json([QID], props='claims'))
+            item_claims = Claims().from_json(entity.get('claims', {}))
+        prop_nr = self.api.get_local_id_by_label(prop_str, 'property')
+        return self.__return_values(prop_nr, item_claims)
     
     def __return_values(self, prop_nr, claims):
         """
@@ -191,21 +353,19 @@ class MardiItem(ItemEntity):
 
         Args:
             prop_nr: ID corresponding to the property
-            claims: Claims to be processed corresponding to an item.
+            claims (Claims): Claims to be processed corresponding to
+                an item.
 
         Returns:
             values (list): List of all values appearing in the 
                 given claims corresponding to prop_nr.
         """
         values = []
-        if prop_nr in claims:
-            for mainsnak in claims[prop_nr]:
-                if mainsnak['mainsnak']['datatype'] in ['string', 'external-id']:
-                    values.append(mainsnak['mainsnak']['datavalue']['value'])
-                elif mainsnak['mainsnak']['datatype'] == 'wikibase-item':
-                    values.append(mainsnak['mainsnak']['datavalue']['value']['id'])
-                elif mainsnak['mainsnak']['datatype'] == 'time':
-                    values.append(mainsnak['mainsnak']['datavalue']['value']['time'])
+        for claim in claims.get(prop_nr):
+            mainsnak = claim.mainsnak
+            extractor = VALUE_EXTRACTORS.get(mainsnak.datatype)
+            if extractor and mainsnak.datavalue:
+                values.append(extractor(mainsnak.datavalue['value']))
         return values
 
     def get_QID(self):
@@ -215,14 +375,10 @@ class MardiItem(ItemEntity):
         Returns:
             QIDs (list): List of QID
         """
-        label = ""
-        if 'en' in self.labels.values:
-            label = self.labels.values['en'].value
+        en = self.labels.values.get('en')
+        label = en.value if en else ""
 
-        importer_endpoint = self.api.importer_api
-        response = requests.get(f'{importer_endpoint}/search/items/{label}')
-        response = response.json()
-        return response.get('QID') or []
+        return list(_search_items(self.api.session, self.api.importer_api, label))
 
     def add_linker_claim(self, wikidata_id):
         """Function for in-place addition of a claim with the
@@ -245,6 +401,14 @@ class MardiProperty(PropertyEntity):
     def new(self, **kwargs):
         return MardiProperty(api=self.api, **kwargs)
 
+    def write(self, **kwargs):
+        entity = super().write(**kwargs)
+        # The new label must be visible to later searches
+        label = entity.labels.get('en')
+        if label:
+            invalidate_search(label.value)
+        return entity
+
     def get(self, entity_id, **kwargs):
         json_data = super(PropertyEntity, self)._get(entity_id=entity_id, **kwargs)
         return MardiProperty(api=self.api).from_json(json_data=json_data['entities'][entity_id])
@@ -259,14 +423,10 @@ class MardiProperty(PropertyEntity):
         """Returns the PID of the property with the same label
         """
 
-        label = ""
-        if 'en' in self.labels.values:
-            label = self.labels.values['en'].value
+        en = self.labels.values.get('en')
+        label = en.value if en else ""
 
-        importer_endpoint = self.api.importer_api
-        response = requests.get(f'{importer_endpoint}/search/properties/{label}')
-        response = response.json()
-        return response.get('PID') or []
+        return _search_properties(self.api.session, self.api.importer_api, label) or []
 
     def add_linker_claim(self, wikidata_id):
         """Function for in-place addition of a claim with the
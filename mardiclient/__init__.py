@@ -1,5 +1,5 @@
 __version__ = "0.0.1"
 from .MardiClient import MardiClient
-from .MardiEntities import MardiItem, MardiProperty
+from .MardiEntities import MardiItem, MardiProperty, invalidate_search
 from .mardi_config import config
 from .utils import MardiDisambiguator
\ No newline at end of file
@@ -0,0 +1,60 @@
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from wikibaseintegrator.wbi_config import config as wbi_config
+from wikibaseintegrator.wbi_helpers import execute_sparql_query
+
+MARDI_SPARQL_PREFIX = (
+    "PREFIX wd: <https://portal.mardi4nfdi.de/entity/>\n"
+    "PREFIX wdt: <https://portal.mardi4nfdi.de/prop/direct/>"
+)
+
+class MardiAPIMixin:
+    """Session and SPARQL helpers shared by MardiClient and
+    MardiDisambiguator. Classes using it set self._sparql_prefix,
+    usually from get_sparql_prefix()."""
+
+    @staticmethod
+    def get_session(session=None):
+        """
+        Sets up a session which keeps connections alive and retries
+        failed requests, as used for the importer API
+
+        Args:
+            session (requests.Session): Session to be set up. A new
+                one is created if not given.
+
+        Returns:
+            requests.sessions.Session object
+        """
+        session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                              max_retries=Retry(total=3, backoff_factor=0.2))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Accept': 'application/json'})
+        return session
+
+    @staticmethod
+    def get_sparql_prefix():
+        """Returns the MaRDI prefixes for wd: and wdt: when the
+        configured endpoint is the portal, otherwise None"""
+        if (wbi_config['SPARQL_ENDPOINT_URL'] == 
+            'http://query.portal.mardi4nfdi.de/proxy/wdqs/bigdata/namespace/wdq/sparql'):
+            return MARDI_SPARQL_PREFIX
+
+    def execute_sparql(self, query, **kwargs):
+        """Runs a SPARQL query against the configured endpoint.
+
+        Args:
+            query (str): SPARQL query.
+            **kwargs: Passed on to execute_sparql_query, e.g.
+                max_retries.
+
+        Returns:
+            list: Result bindings of the query.
+        """
+        result = execute_sparql_query(query, self._sparql_prefix, **kwargs)
+        return result['results']['bindings']
@@ -1,17 +1,28 @@
-import requests
+import logging
 
+from concurrent.futures import ThreadPoolExecutor
+
+from .mardi_api import MardiAPIMixin
 from .mardi_config import config
-from .MardiEntities import MardiItem, MardiProperty
+from .MardiEntities import MardiItem, MardiProperty, response_json
 from wikibaseintegrator import WikibaseIntegrator, wbi_login
 from wikibaseintegrator.wbi_config import config as wbi_config
 from wikibaseintegrator.wbi_helpers import merge_items
 from wikibaseintegrator.wbi_login import LoginError
 
-class MardiDisambiguator(WikibaseIntegrator):
+log = logging.getLogger(__name__)
+
+class MardiDisambiguator(MardiAPIMixin, WikibaseIntegrator):
     def __init__(self, **kwargs) -> None:
         super().__init__(is_bot=True)
         self.login = self.config(**kwargs)
-        self.session = self.get_session(**kwargs)
+        if self.login is None:
+            raise WBAPIException('Login failed')
+        # Reuse the logged in session instead of logging in a second time
+        self.session = self.get_session(self.login.get_session())
+        self.csrf_token = self.get_csrf_token()
+        self._sparql_prefix = self.get_sparql_prefix()
+        self.importer_api = config['IMPORTER_API_URL']
         self.item = MardiItem(api=self)
         self.property = MardiProperty(api=self)
 
@@ -38,39 +49,8 @@ class MardiDisambiguator(WikibaseIntegrator):
                     password=password
                 )
         except LoginError:
-            print('Wrong credentials')
+            log.error('Wrong credentials')
 
-    @staticmethod
-    def get_session(user, password):
-        """
-        Starts a new session and logins using a bot account.
-        @username, @botpwd string: credentials of an existing bot user
-        @returns requests.sessions.Session object
-        """
-        # create a new session
-        session = requests.Session()
-
-        # get login token
-        r1 = session.get(config['MEDIAWIKI_API_URL'], params={
-            'format': 'json',
-            'action': 'query',
-            'meta': 'tokens',
-            'type': 'login'
-        })
-        # login with bot account
-        r2 = session.post(config['MEDIAWIKI_API_URL'], data={
-            'format': 'json',
-            'action': 'login',
-            'lgname': user,
-            'lgpassword': password,
-            'lgtoken': r1.json()['query']['tokens']['logintoken'],
-        })
-        # raise when login failed
-        if r2.json()['login']['result'] != 'Success':
-            raise WBAPIException(r2.json()['login'])
-            
-        return session
-    
     def get_csrf_token(self):
         """Gets a security (CSRF) token."""
         params = {
@@ -80,10 +60,29 @@ class MardiDisambiguator(WikibaseIntegrator):
             "format": "json"
         }
         r1 = self.session.get(config['MEDIAWIKI_API_URL'], params=params)
-        token = r1.json()['query']['tokens']['csrftoken']
+        token = response_json(r1)['query']['tokens']['csrftoken']
 
         return token
 
+    def post_with_token(self, params):
+        """
+        Posts an action to the MediaWiki API using the cached CSRF
+        token. The token is renewed once if the API rejects it.
+        @params dict: parameters of the action, without token
+        @returns dict: API response
+        """
+        for _ in range(2):
+            params['token'] = self.csrf_token
+            r1 = self.session.post(config['MEDIAWIKI_API_URL'], data=params)
+            response = response_json(r1)
+            if response.get('error', {}).get('code') != 'badtoken':
+                break
+            self.csrf_token = self.get_csrf_token()
+
+        if 'error' in response:
+            raise WBAPIException(response['error'])
+        return response
+
     def get_page(self, target):
         target = f"Person:{target}"
         params = {
@@ -93,31 +92,22 @@ class MardiDisambiguator(WikibaseIntegrator):
             "format": "json"
         }
         r1 = self.session.get(config['MEDIAWIKI_API_URL'], params=params)
-        if 'error' in r1.json().keys():
+        if 'error' in response_json(r1):
             return False
         return True
     
     def delete_page(self, target):
-        token = self.get_csrf_token()
-
         target = f"Person:{target}"
         
         params = {
             "action": "delete",
             "format": "json",
             "title": target,
-            "token": token,
             "reason": "Duplicate"
         }
-        r1 = self.session.post(config['MEDIAWIKI_API_URL'], data=params)
-        r1.json = r1.json()
-        
-        if 'error' in r1.json.keys():
-            raise WBAPIException(r1.json['error'])
+        self.post_with_token(params)
         
     def move_page(self, source, target):
-        token = self.get_csrf_token()
-
         target = f"Person:{target}"
         source = f"Person:{source}"
         
@@ -126,27 +116,22 @@ class MardiDisambiguator(WikibaseIntegrator):
             "format": "json",
             "from": source,
             "to": target,
-            "token": token,
             "reason": "Duplicate"
         }
-        r1 = self.session.post(config['MEDIAWIKI_API_URL'], data=params)
-        r1.json = r1.json()
-        
-        if 'error' in r1.json.keys():
-            raise WBAPIException(r1.json['error'])
+        self.post_with_token(params)
 
     def merge_authors(self, source_QID, target_QID):
-        source_item = self.item.get(entity_id=source_QID)
-        target_item = self.item.get(entity_id=target_QID)
-
-        source_label, target_label = "", ""
-
-        source_dict = source_item.labels.get_json()
-        target_dict = target_item.labels.get_json()
-        if 'en' in source_dict.keys():
-            source_label = source_dict['en']['value']
-        if 'en' in target_dict.keys():
-            target_label = target_dict['en']['value']
+        # Both items are independent, so fetch them concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            source_future = executor.submit(self.item.get, entity_id=source_QID)
+            target_future = executor.submit(self.item.get, entity_id=target_QID)
+            source_item = source_future.result()
+            target_item = target_future.result()
+
+        source_en = source_item.labels.values.get('en')
+        target_en = target_item.labels.values.get('en')
+        source_label = source_en.value if source_en else ""
+        target_label = target_en.value if target_en else ""
         
         if len(target_label) < len(source_label):
             source_QID, target_QID = target_QID, source_QID
@@ -183,6 +168,6 @@ class MardiDisambiguator(WikibaseIntegrator):
         return results['from']['id'], results['to']['id'] 
 
 
-class WBAPIException(BaseException):
+class WBAPIException(Exception):
     """Raised when the wikibase Open API throws an error"""
     pass
\ No newline at end of file
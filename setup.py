@@ -9,8 +9,8 @@ setup(
     author_email='accounts_ta5@mardi4nfdi.de',
     packages=['mardiclient'],
     install_requires=[
-        "mysql-connector-python",
-        "sqlalchemy",
+        "orjson",
+        "requests",
         "wikibaseintegrator"
     ],
     classifiers=[
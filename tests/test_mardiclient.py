@@ -0,0 +1,245 @@
+import json
+from unittest import mock
+
+import pytest
+
+from mardiclient import MardiClient, MardiDisambiguator
+from mardiclient.utils import WBAPIException
+
+
+def make_client():
+    with mock.patch.object(MardiClient, 'config', return_value=None):
+        return MardiClient(user='user', password='password')
+
+
+def json_response(data):
+    response = mock.Mock()
+    response.content = json.dumps(data).encode()
+    response.json.return_value = data
+    return response
+
+
+def token_response(token):
+    return json_response({'query': {'tokens': {'csrftoken': token}}})
+
+
+def make_disambiguator(session):
+    login = mock.Mock()
+    login.get_session.return_value = session
+    with mock.patch.object(MardiDisambiguator, 'config', return_value=login):
+        return MardiDisambiguator(user='user', password='password')
+
+
+def test_label_cache_shared_with_item_copies():
+    mc = make_client()
+    mc._label_cache[('wdt:P31', 'property')] = 'P31'
+
+    assert mc.item.new().api.get_local_id_by_label('wdt:P31', 'property') == 'P31'
+
+
+def test_add_claim_through_item_copy():
+    mc = make_client()
+    mc._label_cache[('wdt:P31', 'property')] = 'P31'
+    mc._label_cache[('wd:Q5', 'item')] = 'Q5'
+    mc._datatype_cache['P31'] = 'wikibase-item'
+
+    item = mc.item.new()
+    item.add_claim('wdt:P31', 'wd:Q5')
+
+    claim = item.claims.get('P31')[0]
+    assert claim.mainsnak.datavalue['value']['id'] == 'Q5'
+
+
+def test_add_claim_with_local_ids():
+    mc = make_client()
+    mc._datatype_cache['P31'] = 'wikibase-item'
+
+    item = mc.item.new()
+    item.add_claim('P31', 'Q5')
+
+    assert item.claims.get('P31')[0].mainsnak.datavalue['value']['id'] == 'Q5'
+
+
+def test_local_id_fast_path_is_ascii_only():
+    mc = make_client()
+    assert mc.get_local_id_by_label('P31', 'property') == 'P31'
+    with mock.patch.object(MardiClient, '_resolve_local_id', return_value=None) as resolve:
+        assert mc.get_local_id_by_label('P٣١', 'property') is None
+    resolve.assert_called_once()
+
+
+def test_instance_of_resolved_once_per_client():
+    mc = make_client()
+    with mock.patch.object(MardiClient, '_resolve_local_id', return_value='P31') as resolve:
+        assert mc.item.new().api.instance_of_PID == 'P31'
+        assert mc.item.new().api.instance_of_PID == 'P31'
+    resolve.assert_called_once_with('instance of', 'property')
+
+
+def test_search_cache_expires_and_invalidates():
+    from mardiclient import MardiEntities
+
+    session = mock.Mock()
+    session.get.return_value.content = b'{"PID": null}'
+    session.get.return_value.json.return_value = {'PID': None}
+
+    assert MardiEntities._search_properties(session, 'endpoint', 'new label') is None
+    assert MardiEntities._search_properties(session, 'endpoint', 'new label') is None
+    assert session.get.call_count == 1
+
+    MardiEntities.invalidate_search('new label')
+    MardiEntities._search_properties(session, 'endpoint', 'new label')
+    assert session.get.call_count == 2
+
+    with mock.patch.object(MardiEntities, 'SEARCH_CACHE_TTL', 0):
+        MardiEntities.invalidate_search('new label')
+        MardiEntities._search_properties(session, 'endpoint', 'new label')
+        MardiEntities._search_properties(session, 'endpoint', 'new label')
+    assert session.get.call_count == 4
+
+
+def test_sparql_string_escapes_control_characters():
+    from mardiclient.MardiEntities import sparql_string
+
+    assert sparql_string('a "b"\\c') == '"a \\"b\\"\\\\c"'
+    assert sparql_string('line\nbreak\r\ttab') == '"line\\nbreak\\r\\ttab"'
+
+
+def test_item_labels_follow_search_invalidation():
+    from mardiclient import invalidate_search
+
+    mc = make_client()
+    mc.importer_api = 'importer'
+    binding = {'item': {'type': 'uri', 'value': 'https://portal.mardi4nfdi.de/entity/Q7'},
+               'label': {'type': 'literal', 'value': 'resolved label', 'xml:lang': 'en'}}
+    with mock.patch.object(MardiClient, 'execute_sparql', return_value=[binding]):
+        assert mc.resolve_many(['resolved label'], 'item') == {'resolved label': ['Q7']}
+
+    mc.session = mock.Mock()
+    assert mc.get_local_id_by_label('resolved label', 'item') == ['Q7']
+    mc.session.get.assert_not_called()
+
+    invalidate_search('resolved label')
+    mc.session.get.return_value.content = b'{"QID": ["Q8"]}'
+    mc.session.get.return_value.json.return_value = {'QID': ['Q8']}
+    assert mc.get_local_id_by_label('resolved label', 'item') == ['Q8']
+
+
+def test_sparql_value_keeps_urls():
+    from mardiclient.MardiEntities import sparql_value
+
+    assert sparql_value({'type': 'uri', 'value': 'https://portal.mardi4nfdi.de/entity/Q7'}) == 'Q7'
+    assert sparql_value({'type': 'uri', 'value': 'https://doi.org/10.1/abc'}) == 'https://doi.org/10.1/abc'
+
+
+def test_instance_of_with_property_compares_wikibase_values():
+    mc = make_client()
+    mc._label_cache[('instance of', 'property')] = 'P31'
+    item = mc.item.new()
+    item.labels.set(language='en', value='Paper')
+
+    binding = {'item': {'type': 'uri', 'value': 'https://portal.mardi4nfdi.de/entity/Q9'}}
+    time_value = {'time': '+2020-00-00T00:00:00Z', 'timezone': 0, 'before': 0, 'after': 0,
+                  'precision': 9, 'calendarmodel': 'http://www.wikidata.org/entity/Q1985727'}
+    claims = {'P28': [{'mainsnak': {'snaktype': 'value', 'property': 'P28', 'datatype': 'time',
+                                    'datavalue': {'value': time_value, 'type': 'time'}},
+                       'type': 'statement', 'rank': 'normal', 'id': 'Q9$1'}]}
+    entities = {'entities': {'Q9': {'id': 'Q9', 'claims': claims}}}
+    with mock.patch.object(MardiClient, 'execute_sparql', return_value=[binding]), \
+         mock.patch('mardiclient.MardiEntities.mediawiki_api_call_helper', return_value=entities):
+        assert item.is_instance_of_with_property('Q5', 'P28', '+2020-00-00T00:00:00Z') == 'Q9'
+        assert item.is_instance_of_with_property('Q5', 'P28', '+2021-00-00T00:00:00Z') is None
+
+
+def make_item(mc, label, description):
+    item = mc.item.new()
+    item.labels.set(language='en', value=label)
+    item.descriptions.set(language='en', value=description)
+    return item
+
+
+def test_exists_returns_sparql_match():
+    mc = make_client()
+    item = make_item(mc, 'Paper', 'A paper')
+    binding = {'item': {'type': 'uri', 'value': 'https://portal.mardi4nfdi.de/entity/Q3'}}
+    with mock.patch.object(MardiClient, 'execute_sparql', return_value=[binding]) as execute, \
+         mock.patch('mardiclient.MardiEntities.mediawiki_api_call_helper') as helper:
+        assert item.exists() == 'Q3'
+    assert execute.call_args.kwargs == {'max_retries': 1, 'retry_after': 0}
+    helper.assert_not_called()
+
+
+def test_exists_falls_back_to_batched_descriptions():
+    mc = make_client()
+    item = make_item(mc, 'Fallback paper', 'A paper')
+    entities = {'entities': {
+        'Q1': {'id': 'Q1', 'descriptions': {'en': {'language': 'en', 'value': 'Another paper'}}},
+        'Q2': {'id': 'Q2', 'descriptions': {'en': {'language': 'en', 'value': 'A paper'}}},
+    }}
+    with mock.patch.object(MardiClient, 'execute_sparql', side_effect=Exception('down')), \
+         mock.patch('mardiclient.MardiEntities._search_items', return_value=('Q1', 'Q2')), \
+         mock.patch('mardiclient.MardiEntities.mediawiki_api_call_helper',
+                    return_value=entities) as helper:
+        assert item.exists() == 'Q2'
+    helper.assert_called_once()
+    assert helper.call_args.kwargs['data']['ids'] == 'Q1|Q2'
+    assert helper.call_args.kwargs['data']['languages'] == 'en'
+
+
+def test_resolve_many_skips_fresh_item_labels():
+    mc = make_client()
+    mc.importer_api = 'importer'
+    binding = {'item': {'type': 'uri', 'value': 'https://portal.mardi4nfdi.de/entity/Q4'},
+               'label': {'type': 'literal', 'value': 'first label', 'xml:lang': 'en'}}
+    with mock.patch.object(MardiClient, 'execute_sparql', return_value=[binding]) as execute:
+        assert mc.resolve_many(['first label', 'Q٣'], 'item') == {'first label': ['Q4']}
+        assert '"Q٣"@en' in execute.call_args.args[0]
+        assert mc.resolve_many(['first label'], 'item') == {'first label': ['Q4']}
+    execute.assert_called_once()
+
+
+def test_post_with_token_renews_rejected_token():
+    session = mock.Mock()
+    session.get.side_effect = [token_response('old'), token_response('new')]
+    responses = [json_response({'error': {'code': 'badtoken'}}),
+                 json_response({'delete': {'title': 'Person:1'}})]
+    tokens = []
+
+    def post(url, data):
+        tokens.append(data['token'])
+        return responses.pop(0)
+
+    session.post.side_effect = post
+    disambiguator = make_disambiguator(session)
+
+    assert disambiguator.post_with_token({'action': 'delete'}) == {'delete': {'title': 'Person:1'}}
+    assert tokens == ['old', 'new']
+    assert disambiguator.csrf_token == 'new'
+
+
+def test_post_with_token_raises_other_errors():
+    session = mock.Mock()
+    session.get.return_value = token_response('token')
+    session.post.return_value = json_response({'error': {'code': 'permissiondenied'}})
+    disambiguator = make_disambiguator(session)
+
+    with pytest.raises(WBAPIException):
+        disambiguator.post_with_token({'action': 'delete'})
+    session.post.assert_called_once()
+    session.get.assert_called_once()
+
+
+def test_disambiguator_raises_on_failed_login():
+    with mock.patch.object(MardiDisambiguator, 'config', return_value=None):
+        with pytest.raises(WBAPIException):
+            MardiDisambiguator(user='user', password='wrong')
+
+
+def test_disambiguator_reuses_login_session():
+    session = mock.Mock()
+    session.get.return_value = token_response('token')
+    disambiguator = make_disambiguator(session)
+
+    assert disambiguator.session is session
+    assert disambiguator.item.api.session is session
+    assert disambiguator.csrf_token == 'token'